@@ -4,6 +4,7 @@ from dotenv import load_dotenv
 import pymupdf
 from openai import OpenAI
 import psycopg2
+from psycopg2.extras import execute_values
 from tqdm import tqdm
 import re
 
@@ -137,35 +138,22 @@ def save_book(book, database, db_user, db_password) -> None:
 
     book_id = cur.fetchone()[0]
  
-    for (sidenr, chunk), embedding in zip(book["chunks"], book["embeddings"]):
-        chunk_tekst = extract_text_from_chunk(chunk)
-
-        # cur.execute(
-        #     "INSERT INTO chunks_large(book_id, sidenr, chunk, embedding) "
-        #     + "VALUES (%s, %s, %s, %s)",
-        #     (book_id, sidenr, chunk_tekst, embedding),
-        # )
-        # cur.execute(
-        #     "INSERT INTO chunks_small(book_id, sidenr, chunk, embedding) "
-        #     + "VALUES (%s, %s, %s, %s)",
-        #     (book_id, sidenr, chunk_tekst, embedding),
-        # )
-        # cur.execute(
-        #     "INSERT INTO chunks(book_id, sidenr, chunk, embedding) "
-        #     + "VALUES (%s, %s, %s, %s)",
-        #     (book_id, sidenr, chunk_tekst, embedding),
-        # )
-        # cur.execute(
-        #     "INSERT INTO chunks_tiny(book_id, sidenr, chunk, embedding) "
-        #     + "VALUES (%s, %s, %s, %s)",
-        #     (book_id, sidenr, chunk_tekst, embedding),
-        # )
-
-        cur.execute(
-            "INSERT INTO chunks_udentitel(book_id, sidenr, chunk, embedding) "
-            + "VALUES (%s, %s, %s, %s)",
-            (book_id, sidenr, chunk_tekst, embedding),
-        )
+    rækker = [
+        (book_id, sidenr, extract_text_from_chunk(chunk), embedding)
+        for (sidenr, chunk), embedding in zip(book["chunks"], book["embeddings"])
+    ]
+
+    # Alle chunks for bogen indsættes i én INSERT i stedet for én pr. chunk
+    # execute_values(cur, "INSERT INTO chunks_large(book_id, sidenr, chunk, embedding) VALUES %s", rækker)
+    # execute_values(cur, "INSERT INTO chunks_small(book_id, sidenr, chunk, embedding) VALUES %s", rækker)
+    # execute_values(cur, "INSERT INTO chunks(book_id, sidenr, chunk, embedding) VALUES %s", rækker)
+    # execute_values(cur, "INSERT INTO chunks_tiny(book_id, sidenr, chunk, embedding) VALUES %s", rækker)
+    execute_values(
+        cur,
+        "INSERT INTO chunks_udentitel(book_id, sidenr, chunk, embedding) VALUES %s",
+        rækker,
+        page_size=1000,
+    )
     cn.commit()
     cur.close()
     cn.close()
@@ -1,13 +1,17 @@
 from psycopg import AsyncConnection
+from psycopg_pool import AsyncConnectionPool
+from pgvector.psycopg import register_vector_async
+import numpy as np
 import os
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import json
 from enum import Enum
 from contextlib import asynccontextmanager
+from collections import OrderedDict
 
 class ChunkSize(str, Enum):
     mini = "mini"
@@ -21,16 +25,114 @@ class DistanceFunction(str, Enum):
     cosine = "cosine"
     l2 = "l2"
 
-db_conn = None
+# Supported distance functions are:
+#     <-> - L2 distance (Euclidean)
+#     <#> - (negative) inner product
+#     <=> - cosine distance
+#     <+> - L1 distance (Manhattan)
+TABELLER = {
+    ChunkSize.stor: "chunks_large",
+    ChunkSize.lille: "chunks_small",
+    ChunkSize.mini: "chunks_tiny",
+    ChunkSize.medium: "chunks",
+}
+
+AFSTANDSOPERATORER = {
+    DistanceFunction.cosine: "<=>",
+    DistanceFunction.l1: "<+>",
+    DistanceFunction.inner_product: "<#>",
+    DistanceFunction.l2: "<->",
+}
+
+# De nærmeste chunks findes i en underforespørgsel uden join, så ORDER BY ... LIMIT
+# står direkte på chunk-tabellen og kan bruge vektorindekset. Bøgerne hentes
+# først bagefter til de 5 fundne chunks.
+def byg_sql(tabel: str, distance_operator: str) -> str:
+    return f"SELECT b.pdf_navn, b.titel, b.forfatter, c.sidenr, c.chunk, c.distance " \
+    f"FROM (SELECT book_id, sidenr, chunk, embedding {distance_operator} %(vektor)s AS distance " \
+    f"FROM {tabel} " \
+    f"WHERE length(trim(chunk)) > 20 " \
+    f"ORDER BY embedding {distance_operator} %(vektor)s ASC LIMIT 5) c " \
+    f"inner join books b on b.id = c.book_id " \
+    f"ORDER BY c.distance ASC"
+
+# Der er kun et fast antal kombinationer af chunkstørrelse og afstandsfunktion,
+# så SQL'en bygges én gang ved opstart i stedet for ved hver søgning.
+SQL_FORESPØRGSLER = {
+    (chunk_size, distance_function): byg_sql(TABELLER[chunk_size], AFSTANDSOPERATORER[distance_function])
+    for chunk_size in ChunkSize
+    for distance_function in DistanceFunction
+}
+
+# Søgeparametre for vektorindekserne, som kan sættes fra miljøet:
+#     HNSW_EF_SEARCH - størrelsen af kandidatlisten under en HNSW indeksscanning
+#                      (pgvectors standard er 40). Højere værdi giver bedre recall men
+#                      langsommere søgninger, og værdien er også det største antal
+#                      rækker scanningen kan returnere. Her sættes den altid,
+#                      med 100 som standard. Gyldige værdier er 1-1000.
+# miljøvariabel: (indstilling, standardværdi, mindste værdi, største værdi)
+INDEKS_INDSTILLINGER = {
+    "HNSW_EF_SEARCH": ("hnsw.ef_search", 100, 1, 1000),
+}
+
+# De seneste søgesvar, så en gentaget søgning hverken kalder OpenAI eller
+# databasen igen. Bøgerne indlæses offline, og cachen tømmes når API'et
+# genstartes.
+SØGE_CACHE_STØRRELSE = 1024
+søge_cache = OrderedDict()
+
+db_pool = None
+openai_client = None
+# (indstilling, værdi) par fra INDEKS_INDSTILLINGER, valideret ved opstart
+indeks_værdier = []
+
+def læs_indstilling(miljøvariabel: str, standard: int, mindste: int, største: int) -> int:
+    tekst = os.getenv(miljøvariabel, None) or str(standard)
+    try:
+        værdi = int(tekst)
+    except ValueError:
+        raise ValueError(f"{miljøvariabel} skal være et heltal, men er '{tekst}'") from None
+    if not mindste <= værdi <= største:
+        raise ValueError(f"{miljøvariabel} skal være mellem {mindste} og {største}, men er {værdi}")
+    return værdi
+
+async def konfigurer_forbindelse(conn: AsyncConnection):
+    # Kaldes af puljen for hver ny forbindelse
+    await register_vector_async(conn)
+    # Søgningerne er korte LIMIT 5 forespørgsler, hvor JIT kompilering
+    # koster mere end den sparer
+    await conn.execute("SET jit = off")
+    for indstilling, værdi in indeks_værdier:
+        await conn.execute("SELECT set_config(%s, %s, false)", (indstilling, værdi))
+    await conn.commit()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    load_dotenv()
     databaseurl = os.getenv("DATABASE_URL", None)
-    global db_conn
-    db_conn= await AsyncConnection.connect(databaseurl)
+    global db_pool, openai_client, indeks_værdier
+    # Indstillingerne læses og valideres én gang her, så en ugyldig værdi giver
+    # en tydelig fejl ved opstart i stedet for fejlende forbindelser i puljen
+    indeks_værdier = [
+        (indstilling, str(læs_indstilling(miljøvariabel, standard, mindste, største)))
+        for miljøvariabel, (indstilling, standard, mindste, største) in INDEKS_INDSTILLINGER.items()
+    ]
+    # Klienten oprettes én gang, så dens HTTP forbindelser genbruges mellem søgninger
+    openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY", None))
+    # En pulje af forbindelser, så samtidige søgninger ikke står i kø
+    # på én fælles forbindelse
+    db_pool = AsyncConnectionPool(
+        databaseurl,
+        min_size=int(os.getenv("DB_POOL_MIN", 2)),
+        max_size=int(os.getenv("DB_POOL_MAX", 10)),
+        configure=konfigurer_forbindelse,
+        open=False,
+    )
+    await db_pool.open(wait=True)
     print("Opstart: Databasen er forbundet")
     yield
-    await db_conn.close()
+    await db_pool.close()
+    await openai_client.close()
     print("Luk ned: Databasen er frakoblet")
 
 app = FastAPI(lifespan=lifespan)
@@ -65,12 +167,12 @@ async def rod_side():
 @app.post("/search")
 async def search(request: Input):
     print(f'Søger efter "{request.query}"...')
-    load_dotenv()
-    openai_key = os.getenv("OPENAI_API_KEY", None)
-    client = OpenAI()
-    client.api_key = openai_key
+    nøgle = (request.query, request.chunk_size, request.distance_function)
+    if nøgle in søge_cache:
+        søge_cache.move_to_end(nøgle)
+        return søge_cache[nøgle]
 
-    vektor = get_embedding(request.query, client)
+    vektor = await get_embedding(request.query, openai_client)
 
     resultater = await find_nærmeste(vektor, request.chunk_size, request.distance_function)
 
@@ -99,8 +201,15 @@ async def search(request: Input):
         )
         dokument["pdf_navn"] = f'{dokument["pdf_navn"]}#page={str(dokument["sidenr"] + 1)}'
         print(f"{dokument["titel"]} side: {dokument['sidenr']}")
-    
-    return json.dumps(dokumenter)
+
+    svar = json.dumps(dokumenter)
+    # Tomme svar caches ikke, da find_nærmeste også giver en tom liste ved databasefejl
+    if dokumenter:
+        søge_cache[nøgle] = svar
+        if len(søge_cache) > SØGE_CACHE_STØRRELSE:
+            søge_cache.popitem(last=False)
+
+    return svar
 
 async def find_nærmeste(vektor: list, chunk_size: str, distance_function: str, ) -> list:
     # host = os.getenv("POSTGRES_HOST", None)
@@ -117,41 +226,15 @@ async def find_nærmeste(vektor: list, chunk_size: str, distance_function: str,
     #     port=host_port
     # ) as cn:
     try:
-        # async with db_conn.connection() as cn:
-        async with db_conn.cursor() as cur:
-
-                # Supported distance functions are:
-                #     <-> - L2 distance (Euclidean)
-                #     <#> - (negative) inner product
-                #     <=> - cosine distance
-                #     <+> - L1 distance (Manhattan)
-                
-                tabel = ""
-                if chunk_size == ChunkSize.stor:
-                    tabel = "chunks_large"
-                elif chunk_size == ChunkSize.lille:
-                    tabel = "chunks_small"
-                elif chunk_size == ChunkSize.mini:
-                    tabel = "chunks_tiny"
-                else:
-                    tabel = "chunks"
-
-                distance_operator = ""
-                if distance_function == DistanceFunction.cosine:
-                    distance_operator = "<=>"
-                elif distance_function == DistanceFunction.l1:
-                    distance_operator = "<+>"
-                elif distance_function == DistanceFunction.inner_product:
-                    distance_operator = "<#>"
-                else:
-                    distance_operator = "<->"
-
-                sql = f"SELECT b.pdf_navn, b.titel, b.forfatter, c.sidenr, c.chunk, embedding {distance_operator} %s AS distance " \
-                f"FROM books b inner join {tabel} c on b.id = c.book_id " \
-                f"WHERE length(trim(c.chunk)) > 20 " \
-                f"ORDER BY embedding {distance_operator} %s ASC LIMIT 5"
-                
-                await cur.execute(sql, (str(vektor),str(vektor)),)
+        async with db_pool.connection() as cn, cn.cursor() as cur:
+
+                sql = SQL_FORESPØRGSLER[(chunk_size, distance_function)]
+
+                # prepare=True gemmer forespørgselsplanen på serveren, så den
+                # ikke skal parses og planlægges igen ved hver søgning
+                # Vektoren sendes binært som float32 og kun én gang, selvom den
+                # bruges både i SELECT og ORDER BY
+                await cur.execute(sql, {"vektor": np.asarray(vektor, dtype=np.float32)}, prepare=True)
 
                 results = await cur.fetchall()
 
@@ -163,12 +246,11 @@ async def find_nærmeste(vektor: list, chunk_size: str, distance_function: str,
 
     return results
 
-def get_embedding(text, client, model="text-embedding-3-small"):
+async def get_embedding(text, client, model="text-embedding-3-small"):
     text = text.replace("\n", " ")
-    embeddings = (
-        client.embeddings.create(input=[text], model=model).data[0].embedding
-    )
-    return embeddings
+    # Kaldet afventes asynkront, så andre søgninger kan køre imens
+    respons = await client.embeddings.create(input=[text], model=model)
+    return respons.data[0].embedding
 
 
 if __name__ == "__main__":